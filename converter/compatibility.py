@@ -6,10 +6,16 @@ import os
 import json
 import shutil
 import uuid
-from typing import List
-from converter.load import load_savedmodel
+from typing import Dict, FrozenSet, List, Tuple
+from converter.load import load_savedmodel, load_savedmodel_meta
 from tensorflow.python.tools.freeze_graph import freeze_graph
+from tensorflow.python.grappler import tf_optimizer
+from tensorflow.core.protobuf import meta_graph_pb2
 import tensorflow as tf
+try:
+	import orjson
+except ImportError:
+	orjson = None
 
 
 def strip_incompatible_ops_dtypes(savedmodel_dir: str, export_path: str, ops: List[str] = None, dtypes: List[str] = None, reshape_for_percept=False):
@@ -21,13 +27,14 @@ def strip_incompatible_ops_dtypes(savedmodel_dir: str, export_path: str, ops: Li
 		ops = list()
 	if dtypes is None:
 		dtypes = list()
-	ops = [op.lower() for op in ops]
-	dtypes = [dtype.lower() for dtype in dtypes]
+	# lowercase once and use frozensets so the per-node membership checks are O(1) hash lookups instead of list scans
+	ops = frozenset(op.lower() for op in ops)
+	dtypes = frozenset(dtype.lower() for dtype in dtypes)
 
-	# load our savedmodel and lobe signature (gives us inputs, outputs, classes, etc. -- meta properties about the model)
-	session, signature = load_savedmodel(savedmodel_dir=savedmodel_dir)
-	# get our tf graph from the session and the list of output tensor names from the signature
-	graph = session.graph
+	# parse just the MetaGraphDef protobuf and lobe signature (gives us inputs, outputs, classes, etc. -- meta
+	# properties about the model) -- the op/dtype dependency walk only needs the graph structure, so don't pay
+	# for a session and restoring all the variables unless we actually have to modify the graph below
+	meta_graph_def, signature = load_savedmodel_meta(savedmodel_dir=savedmodel_dir)
 	# map the output tensors we want to consider for this model -- prune any that are already in the dtype prune list
 	out_tensor_names = {
 		key: val.get("name") for key, val in signature.get("outputs", {}).items()
@@ -39,40 +46,74 @@ def strip_incompatible_ops_dtypes(savedmodel_dir: str, export_path: str, ops: Li
 		print(f"No compatible outputs found for the model. Pruned dtypes {dtypes}")
 		return
 
-	# now traverse the tensorflow graph starting at the outputs and prune the output if it depends on any of the
-	# listed dtypes or ops
-	pruned_out_tensor_names = dict()
+	if not ops and not dtypes:
+		# nothing to prune means no tensor can depend on a pruned op or dtype -- keep every output and skip
+		# the graph walk entirely (the common "just freeze the model" fast path)
+		pruned_out_tensor_names = dict(out_tensor_names)
+	else:
+		# now traverse the graph def starting at the outputs and prune the output if it depends on any of the
+		# listed dtypes or ops
+		pruned_out_tensor_names = dict()
+		# one pass over the graph def builds everything the traversal needs: each node's input edges normalized
+		# to producing-node names, and the nodes that hit the prune lists pre-marked in the dependency cache --
+		# the DFS then only touches plain Python dicts instead of crossing into protobuf accessors per edge
+		inputs_of = dict()
+		depends_cache = dict()
+		for node in meta_graph_def.graph_def.node:
+			inputs_of[node.name] = tuple(input_node_name(node_input) for node_input in node.input)
+			if node_depends(node, ops, dtypes):
+				depends_cache[node.name] = True
+		# results proven for one output hold for every output, so the cache is shared across the loop -- the
+		# graph gets walked at most once in total no matter how many outputs share a backbone
+		for key, tensor_name in out_tensor_names.items():
+			# if this tensor doesn't depend on any of the listed ops or dtypes, add it to our outputs for freeze_graph
+			if not tensor_dependency(inputs_of=inputs_of, name=tensor_name, depends_cache=depends_cache):
+				pruned_out_tensor_names[key] = tensor_name
+
 	new_outs = False
 	pruned_out_shapes = dict()
-	for key, tensor_name in out_tensor_names.items():
-		# if this tensor doesn't depend on any of the listed ops or dtypes, add it to our outputs for freeze_graph
-		if not tensor_dependency(graph=graph, name=tensor_name, ops=ops, dtypes=dtypes):
-			pruned_out_tensor_names[key] = tensor_name
-
-		# if this tensor has shape [None, classes], reshape it to [None, 1, 1, classes] (if we want to reshape it for Azure Percept)
-		tensor = graph.get_tensor_by_name(tensor_name)
-		if tensor.shape.as_list() == [None, len(signature.get("classes", {}).get("Label", []))] and reshape_for_percept:
-			with graph.as_default():
-				reshaped_out = tf.reshape(tensor, [-1, 1, 1, tensor.shape.as_list()[-1]])
-			pruned_out_tensor_names[key] = reshaped_out.name
-			pruned_out_shapes[key] = reshaped_out.shape.as_list()
-			new_outs = True
+	if reshape_for_percept:
+		# injecting the reshape modifies the graph, so only this path pays for the full session load
+		session, _ = load_savedmodel(savedmodel_dir=savedmodel_dir)
+		graph = session.graph
+		# index every tensor in the graph once -- graph.get_tensor_by_name re-parses the name and walks TF's
+		# internal index on every call, so a plain dict lookup is much cheaper
+		tensor_map = {tensor.name: tensor for op in graph.get_operations() for tensor in op.outputs}
+		# compute the expected class count once, and enter the graph context once around the whole loop
+		num_classes = len(signature.get("classes", {}).get("Label", []))
+		with graph.as_default():
+			for key, tensor_name in out_tensor_names.items():
+				# if this tensor has shape [None, classes], reshape it to [None, 1, 1, classes] for Azure Percept
+				# probe the TensorShape dims directly instead of materializing as_list() for the comparison
+				tensor = tensor_map[tensor_name]
+				tensor_shape = tensor.shape
+				if tensor_shape.rank == 2 and tensor_shape[0].value is None and tensor_shape[1].value == num_classes:
+					reshaped_out = tf.reshape(tensor, [-1, 1, 1, num_classes])
+					# add the new tensor to our index so the signature builder below can find it
+					tensor_map[reshaped_out.name] = reshaped_out
+					pruned_out_tensor_names[key] = reshaped_out.name
+					pruned_out_shapes[key] = reshaped_out.shape.as_list()
+					new_outs = True
 
 	if len(pruned_out_tensor_names) == 0:
 		print(f"No compatible outputs found for the model. Pruned dtypes {dtypes}, pruned ops {ops}")
 		return
 
+	# split the :N selectors off the pruned tensor names once -- the signature defs, freeze_graph, and grappler
+	# all want the bare node names
+	pruned_node_names = {key: tensor_name.split(':', 1)[0] for key, tensor_name in pruned_out_tensor_names.items()}
+
 	if new_outs:
 		with graph.as_default():
-			input_sigs = {tensor_name.split(':')[0]:
-				tf.compat.v1.saved_model.utils.build_tensor_info(
-					graph.get_tensor_by_name(tensor_name)
-				) for tensor_name in [val.get('name') for val in signature.get('inputs', {}).values()]
+			# build the tensor infos from our tensor index instead of get_tensor_by_name lookups -- the reshaped
+			# outputs were added to the index when they were created above
+			input_sigs = {
+				val.get('name').split(':')[0]: tf.compat.v1.saved_model.utils.build_tensor_info(tensor_map[val.get('name')])
+				for val in signature.get('inputs', {}).values()
 			}
-			output_sigs = {tensor_name.split(':')[0]:
-				tf.compat.v1.saved_model.utils.build_tensor_info(
-					graph.get_tensor_by_name(tensor_name)
-				) for tensor_name in list(pruned_out_tensor_names.values())
+			output_sigs = {
+				pruned_node_names[key]: tf.compat.v1.saved_model.utils.build_tensor_info(tensor_map[tensor_name])
+				for key, tensor_name in pruned_out_tensor_names.items()
 			}
 			prediction_signature = tf.compat.v1.saved_model.signature_def_utils.build_signature_def(
 				inputs=input_sigs, outputs=output_sigs, method_name=tf.saved_model.PREDICT_METHOD_NAME
@@ -89,7 +130,7 @@ def strip_incompatible_ops_dtypes(savedmodel_dir: str, export_path: str, ops: Li
 			builder.save()
 
 	# freeze_graph expects a comma separated list of tensor names without the :0 selectors
-	output_node_names = ','.join([name.split(':')[0] for name in pruned_out_tensor_names.values()])
+	output_node_names = ','.join(pruned_node_names.values())
 	print(f"Using outs: {output_node_names}")
 
 	# freeze the graph! this prunes anything not used to create the output node names
@@ -108,17 +149,24 @@ def strip_incompatible_ops_dtypes(savedmodel_dir: str, export_path: str, ops: Li
 		saved_model_tags=','.join(signature.get('tags'))
 	)
 
-	# make the signature json reflect the pruned outputs
-	for out_key in list(signature.get("outputs", {}).keys()):
-		if out_key not in pruned_out_tensor_names:
-			del signature.get("outputs", {})[out_key]
-		# otherwise if we reshaped the output, update the tensor name and shape
-		elif new_outs and out_key in pruned_out_shapes:
-			signature.get("outputs", {})[out_key]["shape"] = pruned_out_shapes[out_key]
-			signature.get("outputs", {})[out_key]["name"] = pruned_out_tensor_names[out_key]
+	# run grappler's optimizers over the frozen graph to fold constants and prune dead nodes -- openvino's
+	# model optimizer re-reads this file, so smaller means faster downstream conversion
+	optimize_frozen_graph(export_path=export_path, output_node_names=list(pruned_node_names.values()))
+
+	# make the signature json reflect the pruned outputs -- rebuild the dict once instead of deleting in a loop
+	outputs = signature.get("outputs", {})
+	signature["outputs"] = {key: val for key, val in outputs.items() if key in pruned_out_tensor_names}
+	# if we reshaped any outputs, update their tensor names and shapes
+	for out_key in pruned_out_shapes:
+		signature["outputs"][out_key]["shape"] = pruned_out_shapes[out_key]
+		signature["outputs"][out_key]["name"] = pruned_out_tensor_names[out_key]
 	out_signature_filename = os.path.join(os.path.dirname(os.path.abspath(export_path)), "signature_frozen_graph.json")
-	with open(out_signature_filename, 'w') as f:
-		json.dump(signature, f)
+	if orjson is not None:
+		with open(out_signature_filename, 'wb') as f:
+			f.write(orjson.dumps(signature))
+	else:
+		with open(out_signature_filename, 'w') as f:
+			json.dump(signature, f)
 
 	# cleanup -- if we created a new saved model for the reshaped outputs, delete the saved model directory
 	if new_outs:
@@ -126,22 +174,114 @@ def strip_incompatible_ops_dtypes(savedmodel_dir: str, export_path: str, ops: Li
 		shutil.rmtree(savedmodel_dir)
 
 
-def tensor_dependency(graph: tf.Graph, name: str, ops: List[str], dtypes: List[str]):
+def optimize_frozen_graph(export_path: str, output_node_names: List[str]):
 	"""
-	Given a Tensorflow graph, a tensor name in the graph, and list of ops and dtypes to prune, return if this
-	tensor depends on any of the given ops and dtypes.
+	Run Grappler's graph optimizers (pruning, constant folding, arithmetic simplification, etc.) over a frozen
+	graph file and write the smaller result back in place. Constant folding alone typically folds away the
+	batchnorm constants in Lobe-style classifiers.
+	"""
+	graph_def = tf.compat.v1.GraphDef()
+	with open(export_path, 'rb') as f:
+		graph_def.ParseFromString(f.read())
+
+	# wrap the graph def in a meta graph with the outputs marked as fetches so grappler knows what to keep
+	graph = tf.Graph()
+	with graph.as_default():
+		tf.import_graph_def(graph_def, name="")
+		meta_graph = tf.compat.v1.train.export_meta_graph(graph=graph)
+	fetch_collection = meta_graph_pb2.CollectionDef()
+	for name in output_node_names:
+		fetch_collection.node_list.value.append(name)
+	meta_graph.collection_def["train_op"].CopyFrom(fetch_collection)
+
+	config = tf.compat.v1.ConfigProto()
+	config.graph_options.rewrite_options.optimizers.extend(["pruning", "constfold", "arithmetic", "dependency", "remap"])
+	optimized_graph_def = tf_optimizer.OptimizeGraph(config, meta_graph)
 
-	Recursive search over the graph starting from this tensor to determine dependency on any of the ops or dtypes.
+	with open(export_path, 'wb') as f:
+		f.write(optimized_graph_def.SerializeToString())
+
+
+def tensor_dependency(inputs_of: Dict[str, Tuple[str, ...]], name: str, depends_cache: Dict[str, bool]):
 	"""
-	tensor = graph.get_tensor_by_name(name)
-	# check if this tensor depends on any of the listed dtypes, or if the op that created it is in the list of ops
-	if tensor.dtype.name.lower() in dtypes or tensor.op.type.lower() in ops:
-		return True
-
-	# if this tensor's op has inputs, traverse the graph to see if it depends on any of the dtypes or ops
-	for op_input in tensor.op.inputs:
-		if tensor_dependency(graph, op_input.name, ops, dtypes):
-			return True
+	Given a map of node names to their input node names, a tensor name, and a dependency cache pre-seeded with
+	True for the nodes that hit the prune lists, return if this tensor depends on any of those nodes.
 
-	# otherwise return false, it doesn't depend on any of the listed ops or dtypes :)
+	Iterative depth-first search over the input edges starting from this tensor's node, using only dict and set
+	lookups per edge. The depends_cache memoizes both "depends" and "doesn't depend" results per node across
+	searches, so a node proven either way for one output short-circuits immediately for every other output that
+	shares it.
+	"""
+	root = input_node_name(name)
+	cached = depends_cache.get(root)
+	if cached is not None:
+		return cached
+	# frames hold the current DFS path as (node name, iterator over that node's remaining inputs) so a positive
+	# result can be propagated back to every node on the path
+	frames = [(root, iter(inputs_of[root]))]
+	on_path = {root}
+	while frames:
+		node_name, inputs = frames[-1]
+		input_name = next(inputs, None)
+		if input_name is None:
+			# every input was proven clean, so this node doesn't depend on any of the listed ops or dtypes :)
+			depends_cache[node_name] = False
+			on_path.discard(node_name)
+			frames.pop()
+			continue
+		# guard against revisiting a node already on the current path (e.g. frames in while-loop graphs)
+		if input_name in on_path:
+			continue
+		cached = depends_cache.get(input_name)
+		if cached is None:
+			# not classified yet, descend into this input's own inputs
+			frames.append((input_name, iter(inputs_of[input_name])))
+			on_path.add(input_name)
+			continue
+		if cached:
+			# a dependency was found -- every node on the current path depends on it too
+			for path_node_name, _ in frames:
+				depends_cache[path_node_name] = True
+			return True
 	return False
+
+
+# caches for the lowered op type strings and dtype enum names -- both are small closed vocabularies repeated
+# across thousands of nodes, so caching turns the per-node str.lower() allocations into dict reads
+op_type_lower_cache = dict()
+dtype_name_cache = dict()
+
+
+def node_depends(node: tf.compat.v1.NodeDef, ops: FrozenSet[str], dtypes: FrozenSet[str]) -> bool:
+	"""
+	Return if this node itself is one of the pruned ops or produces one of the pruned dtypes.
+	"""
+	op_type = op_type_lower_cache.get(node.op)
+	if op_type is None:
+		op_type = op_type_lower_cache.setdefault(node.op, node.op.lower())
+	return op_type in ops or node_dtype_name(node) in dtypes
+
+
+def input_node_name(tensor_name: str) -> str:
+	"""
+	Convert a tensor or NodeDef input name to the name of its producing node -- strips the ^ control dependency
+	marker and the :N output selector.
+	"""
+	if tensor_name.startswith('^'):
+		tensor_name = tensor_name[1:]
+	return tensor_name.split(':', 1)[0]
+
+
+def node_dtype_name(node: tf.compat.v1.NodeDef) -> str:
+	"""
+	Best-effort lowercase dtype name for a NodeDef's output -- checks the common dtype attrs ("dtype" for
+	placeholders and constants, "DstT" for casts, "T" for most other ops).
+	"""
+	for attr_name in ("dtype", "DstT", "T"):
+		if attr_name in node.attr and node.attr[attr_name].type:
+			dtype_enum = node.attr[attr_name].type
+			dtype_name = dtype_name_cache.get(dtype_enum)
+			if dtype_name is None:
+				dtype_name = dtype_name_cache.setdefault(dtype_enum, tf.dtypes.as_dtype(dtype_enum).name.lower())
+			return dtype_name
+	return ""
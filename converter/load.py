@@ -5,6 +5,11 @@ import os
 import json
 from typing import Tuple, Dict
 import tensorflow as tf
+from tensorflow.python.saved_model import loader_impl
+try:
+	import orjson
+except ImportError:
+	orjson = None
 
 
 def load_savedmodel(savedmodel_dir: str) -> Tuple[tf.compat.v1.Session, Dict[str, any]]:
@@ -12,6 +17,39 @@ def load_savedmodel(savedmodel_dir: str) -> Tuple[tf.compat.v1.Session, Dict[str
 	Loads a Lobe exported Tensorflow SavedModel and returns the session with the model loaded and our
 	signature file.
 	"""
+	model_path, signature = load_signature(savedmodel_dir)
+
+	# make the tensorflow session and load the model
+	session = tf.compat.v1.Session(graph=tf.Graph())
+	# load our model into the session
+	tf.compat.v1.saved_model.load(sess=session, tags=signature.get("tags"), export_dir=model_path)
+
+	return session, signature
+
+
+def load_savedmodel_meta(savedmodel_dir: str) -> Tuple[tf.compat.v1.MetaGraphDef, Dict[str, any]]:
+	"""
+	Loads just the MetaGraphDef protobuf and our signature file from a Lobe exported Tensorflow SavedModel,
+	without creating a session or restoring any variables. Much faster and lighter than load_savedmodel when
+	you only need to inspect the graph structure (op types, dtypes, connectivity) and not run or modify it.
+	"""
+	model_path, signature = load_signature(savedmodel_dir)
+
+	# parse the SavedModel protobuf and find the meta graph matching our signature tags
+	saved_model = loader_impl.parse_saved_model(model_path)
+	tags = set(signature.get("tags") or [])
+	for meta_graph_def in saved_model.meta_graphs:
+		if set(meta_graph_def.meta_info_def.tags) == tags:
+			return meta_graph_def, signature
+
+	raise ValueError(f"No meta graph with tags {signature.get('tags')} found in SavedModel {savedmodel_dir}")
+
+
+def load_signature(savedmodel_dir: str) -> Tuple[str, Dict[str, any]]:
+	"""
+	Resolves the exported SavedModel folder and loads our signature json file. Returns the resolved model path
+	and the signature dictionary.
+	"""
 	# make sure our exported SavedModel folder exists
 	model_path = os.path.realpath(savedmodel_dir)
 	if not os.path.exists(model_path):
@@ -19,12 +57,7 @@ def load_savedmodel(savedmodel_dir: str) -> Tuple[tf.compat.v1.Session, Dict[str
 
 	# load our signature json file, this shows us the model inputs and outputs
 	# you should open this file and take a look at the inputs/outputs to see their data types, shapes, and names
-	with open(os.path.join(model_path, "signature.json"), "r") as f:
-		signature = json.load(f)
+	with open(os.path.join(model_path, "signature.json"), "rb") as f:
+		signature = orjson.loads(f.read()) if orjson is not None else json.load(f)
 
-	# make the tensorflow session and load the model
-	session = tf.compat.v1.Session(graph=tf.Graph())
-	# load our model into the session
-	tf.compat.v1.saved_model.load(sess=session, tags=signature.get("tags"), export_dir=model_path)
-
-	return session, signature
+	return model_path, signature
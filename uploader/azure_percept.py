@@ -4,14 +4,25 @@ Create an OpenVINO model package to upload to Azure Blob Storage and use IoT Hub
 import argparse
 import os
 import json
+import shutil
 import zipfile
+import hashlib
 import datetime
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from azure.core.exceptions import ResourceExistsError
 from azure.storage.blob import (
-    BlockBlobService,
-    BlobPermissions,
+    BlobBlock,
+    BlobServiceClient,
+    BlobSasPermissions,
+    generate_blob_sas,
 )
 from azure.iot.hub import IoTHubRegistryManager
 from azure.iot.hub.models import Twin, TwinProperties
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 def create_openvino_image_classification_model_config(model_filepath, label_filename='labels.txt'):
     """
@@ -25,58 +36,198 @@ def create_openvino_image_classification_model_config(model_filepath, label_file
     }
     # write the config.json file in the model directory
     config_filepath = os.path.join(os.path.dirname(model_filepath), "config.json")
-    with open(config_filepath, "w") as f:
-        json.dump(config, f)
+    if orjson is not None:
+        with open(config_filepath, "wb") as f:
+            f.write(orjson.dumps(config))
+    else:
+        with open(config_filepath, "w") as f:
+            json.dump(config, f)
     return config_filepath
 
+def model_package_files(config_filepath):
+    """
+    Resolve the files that make up a model package from its config.json filepath. Returns the list of
+    (filepath, arcname) pairs (the .bin weights file last) and the model name stem.
+    """
+    # resolve the config path once instead of repeated os.path string calls (one realpath syscall instead of three)
+    config_path = Path(config_filepath).resolve()
+    config_dir = config_path.parent
+    # read the config json
+    with open(config_path, "rb") as f:
+        config = orjson.loads(f.read()) if orjson is not None else json.load(f)
+    # the package contents: config.json, the label file, and the model xml and bin files
+    model_stem = Path(config["ModelFileName"]).stem
+    model_bin_filename = f"{model_stem}.bin"  # get the model .bin filename from the .xml file name
+    package_files = [
+        (config_path, "config.json"),
+        (config_dir / config["LabelFileName"], config["LabelFileName"]),
+        (config_dir / config["ModelFileName"], config["ModelFileName"]),
+        (config_dir / model_bin_filename, model_bin_filename),
+    ]
+    return package_files, model_stem
+
+def write_model_package_zip(zf, package_files):
+    """
+    Write the model package files into an open ZipFile.
+    """
+    for filepath, arcname in package_files[:-1]:
+        zf.write(filepath, arcname=arcname)
+    # the .bin weights file can be tens to hundreds of MB, so stream it with a 1 MiB buffer instead of
+    # zipfile's default 8 KB copy buffer
+    bin_path, bin_arcname = package_files[-1]
+    with zf.open(bin_arcname, "w", force_zip64=True) as dest:
+        with open(bin_path, "rb") as src:
+            shutil.copyfileobj(src, dest, 1024 * 1024)
+
 def zip_openvino_image_classification_model_package(config_filepath):
     """
     Zip the model directory for uploading to IoT Hub. Return the zip filepath.
     """
-    # read the config json
-    with open(config_filepath, "r") as f:
-        config = json.load(f)
-    # create the zip file from config.json, the label file, and the model xml and bin files
-    config_dirname = os.path.dirname(os.path.abspath(config_filepath))
-    model_no_ext = os.path.splitext(config["ModelFileName"])[0]
-    model_bin_filename = f"{model_no_ext}.bin"  # get the model .bin filename from the .xml file name
-    # create the zip filepath from the model name
-    zip_filepath = os.path.join(os.path.dirname(config_filepath), f"{model_no_ext}.zip")
-    with zipfile.ZipFile(zip_filepath, "w") as zf:
-        zf.write(config_filepath, arcname="config.json")
-        zf.write(os.path.join(config_dirname, config["LabelFileName"]), arcname=config["LabelFileName"])
-        zf.write(os.path.join(config_dirname, config["ModelFileName"]), arcname=config["ModelFileName"])
-        zf.write(os.path.join(config_dirname, model_bin_filename), arcname=os.path.basename(model_bin_filename))
-    return zip_filepath
-    
+    package_files, model_stem = model_package_files(config_filepath)
+    # fingerprint the package inputs and embed the hash in the zip name, so unchanged models can skip the
+    # re-zip here and the re-upload downstream (the blob name will match an already uploaded blob)
+    package_hash = content_hash([filepath for filepath, _ in package_files])
+    # create the zip filepath from the model name and content hash
+    zip_filepath = package_files[0][0].parent / f"{model_stem}-{package_hash}.zip"
+    if zip_filepath.exists():
+        print(f"Model package {zip_filepath} already exists, skipping zip")
+        return str(zip_filepath)
+    # compress the package -- the upload is bandwidth-bound, so trading some local CPU for fewer uploaded bytes wins
+    with zipfile.ZipFile(zip_filepath, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=6, allowZip64=True) as zf:
+        write_model_package_zip(zf, package_files)
+    return str(zip_filepath)
+
+def content_hash(filepaths):
+    """
+    Short content hash over the given files, used to fingerprint a model package so unchanged models can skip
+    re-zipping and re-uploading.
+    """
+    h = hashlib.blake2b(digest_size=8)
+    for filepath in filepaths:
+        with open(filepath, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
 def upload_model_zip(model_zip_filepath, model_container_name, storage_account_name, storage_account_key):
     """
     Upload the OpenVINO model package to Azure Blob Storage and return the download URL.
     """
-    # create a BlockBlobService object with Azure storage account name and key
-    block_blob_service = BlockBlobService(account_name=storage_account_name, account_key=storage_account_key)
-    # create a container for the model
-    block_blob_service.create_container(model_container_name, fail_on_exist=False)
-    # upload the model package to the container
+    # upload the model package to the container, staging blocks with parallel threads -- the blob name embeds
+    # a content hash, so if it already exists the bytes are identical and we can skip the upload entirely
     model_blob_name = os.path.basename(model_zip_filepath)
-    block_blob_service.create_blob_from_path(
-        container_name=model_container_name,
-        blob_name=model_blob_name,
-        file_path=model_zip_filepath,
+    blob_client = get_model_blob_client(model_blob_name, model_container_name, storage_account_name, storage_account_key)
+    if blob_client.exists():
+        print(f"Blob {model_blob_name} already uploaded, skipping upload")
+    else:
+        with open(model_zip_filepath, "rb") as f:
+            blob_client.upload_blob(data=f, overwrite=True, blob_type="BlockBlob", max_concurrency=8)
+    return model_blob_download_url(blob_client, storage_account_name, storage_account_key)
+
+def stream_model_package_upload(config_filepath, model_container_name, storage_account_name, storage_account_key):
+    """
+    Zip the model package straight into an Azure block blob upload instead of writing the zip to disk first,
+    so compression and the network transfer overlap -- end-to-end time becomes max(zip, upload) instead of
+    their sum. Returns the model download URL.
+    """
+    package_files, model_stem = model_package_files(config_filepath)
+    # fingerprint the package inputs so unchanged models can skip the upload entirely
+    package_hash = content_hash([filepath for filepath, _ in package_files])
+    model_blob_name = f"{model_stem}-{package_hash}.zip"
+    blob_client = get_model_blob_client(model_blob_name, model_container_name, storage_account_name, storage_account_key)
+    if blob_client.exists():
+        print(f"Blob {model_blob_name} already uploaded, skipping upload")
+    else:
+        # feed the zip into a stream that stages blocks to Azure in the background as they are produced
+        stream = BlockUploadStream(blob_client)
+        with zipfile.ZipFile(stream, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=6, allowZip64=True) as zf:
+            write_model_package_zip(zf, package_files)
+        stream.commit()
+    return model_blob_download_url(blob_client, storage_account_name, storage_account_key)
+
+class BlockUploadStream:
+    """
+    Writable file-like object that stages 4 MiB blocks to an Azure block blob from a thread pool as bytes are
+    written, overlapping the producer (zip compression) with the network upload. Call commit() when done
+    writing to wait for the in-flight blocks and finalize the blob's block list.
+
+    Deliberately doesn't implement seek() so ZipFile treats it as a streaming target and uses data descriptors
+    instead of seeking back to patch headers.
+    """
+    chunk_size = 4 * 1024 * 1024
+
+    def __init__(self, blob_client, max_workers=8):
+        self.blob_client = blob_client
+        self.block_ids = []
+        self.buffer = bytearray()
+        self.offset = 0
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = []
+        # cap the in-flight blocks so a fast producer doesn't buffer the whole package in memory
+        self.max_pending = max_workers * 2
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.offset += len(data)
+        while len(self.buffer) >= self.chunk_size:
+            self.stage_block(bytes(self.buffer[:self.chunk_size]))
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def stage_block(self, chunk):
+        if len(self.futures) >= self.max_pending:
+            self.futures.pop(0).result()
+        # block ids just need to be unique and uniform length within the blob
+        block_id = f"{len(self.block_ids):032d}"
+        self.block_ids.append(block_id)
+        self.futures.append(self.executor.submit(self.blob_client.stage_block, block_id, chunk))
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def commit(self):
+        if self.buffer:
+            self.stage_block(bytes(self.buffer))
+            self.buffer.clear()
+        # wait for every staged block before committing the block list
+        for future in self.futures:
+            future.result()
+        self.executor.shutdown()
+        self.blob_client.commit_block_list([BlobBlock(block_id=block_id) for block_id in self.block_ids])
+
+def get_model_blob_client(model_blob_name, model_container_name, storage_account_name, storage_account_key):
+    """
+    Get a BlobClient for the model blob, creating the container if it doesn't exist yet.
+    """
+    # create a BlobServiceClient with Azure storage account name and key
+    blob_service = BlobServiceClient(
+        account_url=f"https://{storage_account_name}.blob.core.windows.net",
+        credential=storage_account_key,
     )
-    # get the model download URL
-    model_download_url = block_blob_service.make_blob_url(
-        model_container_name,
-        model_blob_name,
-        protocol='https',
-        sas_token=block_blob_service.generate_blob_shared_access_signature(      
-            container_name=model_container_name,
-            blob_name=model_blob_name,
-            permission=BlobPermissions.READ,
-            expiry=datetime.datetime.utcnow() + datetime.timedelta(hours=1)
-        )
+    # create a container for the model if it doesn't exist yet
+    container_client = blob_service.get_container_client(model_container_name)
+    try:
+        container_client.create_container()
+    except ResourceExistsError:
+        pass
+    return container_client.get_blob_client(model_blob_name)
+
+def model_blob_download_url(blob_client, storage_account_name, storage_account_key):
+    """
+    Get the model blob download URL with a read-only SAS token.
+    """
+    sas_token = generate_blob_sas(
+        account_name=storage_account_name,
+        container_name=blob_client.container_name,
+        blob_name=blob_client.blob_name,
+        account_key=storage_account_key,
+        permission=BlobSasPermissions(read=True),
+        expiry=datetime.datetime.utcnow() + datetime.timedelta(hours=1),
     )
-    return model_download_url
+    return f"{blob_client.url}?{sas_token}"
 
 
 def update_percept_module_twin(model_download_url, connection_string, device_id, module_id='azureeyemodule'):
@@ -115,9 +266,7 @@ if __name__ == '__main__':
     args = parser.parse_args()
     # Create the OpenVINO model package
     config_filepath = create_openvino_image_classification_model_config(args.model)
-    # Zip the model package
-    zip_filepath = zip_openvino_image_classification_model_package(config_filepath)
-    # Upload the model package to Azure Storage
-    model_download_url = upload_model_zip(zip_filepath, args.storage_container_name, args.storage_account_name, args.storage_account_key)
+    # Zip the model package straight into the Azure Storage upload
+    model_download_url = stream_model_package_upload(config_filepath, args.storage_container_name, args.storage_account_name, args.storage_account_key)
     # Update the Azure IoT Hub module twin to use the new model package version
     update_percept_module_twin(model_download_url, args.iothub_connection_string, args.device_id)